@@ -1,49 +1,90 @@
 # coding: utf-8
 """Main module."""
 import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
 
+import numpy as np
 import pandas as pd
 
 from blast2xl.io import read_blast_tsv, write_excel
 
 logger = logging.getLogger(__name__)
 
+NCBI_ACCESSION_REGEX = re.compile(r'^[A-Z]{1,2}\d{5,}(\.\d+)?$')
 
-def blast_tsv_to_df(sample_blast_tsv: Dict[str, Path], top_n_results: int = -1) -> Dict[str, pd.DataFrame]:
-    sample_dfs = {}
-    for sample, tsv_path in sample_blast_tsv.items():
-        logger.debug(f'Parsing sample "{sample}" tabular BLAST result into DataFrame ({tsv_path})')
-        df = read_blast_tsv(tsv_path)
-        logger.debug(f'Parsed sample "{sample}" tabular BLAST result into DataFrame with {df.shape[0]} rows')
-        df['Sample'] = sample
-        df.sort_values(['Query', 'Bitscore'], ascending=[True, False], inplace=True)
-        sample_dfs[sample] = df.groupby('Query').head(top_n_results) if top_n_results > 0 else df
-    return sample_dfs
+
+def top_n_per_group(group_codes: np.ndarray, scores: np.ndarray, n: int) -> np.ndarray:
+    """Get the row indices of the top `n` scoring rows of each group, keeping ties in original order"""
+    order = np.lexsort((-scores, group_codes))
+    sorted_codes = group_codes[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    group_sizes = np.diff(np.r_[group_starts, order.size])
+    ranks = np.arange(order.size) - np.repeat(group_starts, group_sizes)
+    return order[ranks < n]
+
+
+def parse_sample_blast_tsv(sample: str,
+                           tsv_path: Path,
+                           top_n_results: int = -1,
+                           cache: bool = False) -> pd.DataFrame:
+    logger.debug(f'Parsing sample "{sample}" tabular BLAST result into DataFrame ({tsv_path})')
+    df = read_blast_tsv(tsv_path, cache=cache)
+    logger.debug(f'Parsed sample "{sample}" tabular BLAST result into DataFrame with {df.shape[0]} rows')
+    df['Sample'] = sample
+    if top_n_results <= 0:
+        # a stable sort on bitscore alone keeps the hits of each query in descending bitscore order; hits are
+        # grouped by query later by the stable sort on sample and query in output_xlsx_report
+        df.sort_values('Bitscore', ascending=False, kind='stable', inplace=True)
+        return df
+    # top hits of each query in descending bitscore order without sorting the whole DataFrame
+    query_codes, _ = pd.factorize(df['Query'])
+    return df.iloc[top_n_per_group(query_codes, df['Bitscore'].to_numpy(), top_n_results)]
+
+
+def blast_tsv_to_df(sample_blast_tsv: Dict[str, Path],
+                    top_n_results: int = -1,
+                    cache: bool = False,
+                    threads: Optional[int] = None) -> Dict[str, pd.DataFrame]:
+    """Parse each sample BLAST TSV into a DataFrame in a thread pool"""
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+        dfs = executor.map(parse_sample_blast_tsv,
+                           sample_blast_tsv.keys(),
+                           sample_blast_tsv.values(),
+                           repeat(top_n_results),
+                           repeat(cache))
+        return dict(zip(sample_blast_tsv.keys(), dfs))
 
 
 def output_xlsx_report(output_path: str,
                        sample_blast: Dict[str, pd.DataFrame],
-                       top_n_results: int = -1):
-    df_concat: pd.DataFrame = pd.concat((df for sample, df in sample_blast.items()),
-                                        sort=False,
-                                        ignore_index=True) \
-        .sort_values(['Sample', 'Query'], ascending=True)
-    subj_accessions = df_concat['Subject'].astype(str)
-    if subj_accessions.str.match(r'^[A-Z]{1,2}\d{5,}(\.\d+)?$').all():
-        df_concat['Subject_URL'] = 'https://www.ncbi.nlm.nih.gov/nuccore/' + subj_accessions
-    taxids = df_concat['Subject_taxid'].astype(str)
-    df_concat['Subject_taxid_URL'] = 'https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id=' + taxids
-    df_top_results_per_query_seq = df_concat \
-        .groupby(['Sample', 'Query']) \
-        .first() \
-        .reset_index() \
-        .sort_values(['Sample', 'Query'], ascending=True)
+                       top_n_results: int = -1,
+                       compresslevel: int = 1):
+    df_concat: pd.DataFrame = pd.concat(list(sample_blast.values()), sort=False, ignore_index=True)
+    # sort and index in place so that sorted and indexed copies of all results are not held in memory at once
+    df_concat.sort_values(['Sample', 'Query'], ascending=True, inplace=True)
+    # build URLs from the unique subject accessions and taxids only and expand them to all rows via category codes
+    subjects = df_concat['Subject'].astype('category')
+    subj_accessions = subjects.cat.categories.astype(str)
+    if subjects.notna().all() and subj_accessions.str.match(NCBI_ACCESSION_REGEX).all():
+        df_concat['Subject_URL'] = subjects.cat.rename_categories('https://www.ncbi.nlm.nih.gov/nuccore/'
+                                                                  + subj_accessions)
+    # taxids are float if any are missing (BLAST "N/A") so format them as integers
+    taxids = df_concat['Subject_taxid'].astype('Int64').astype('category')
+    df_concat['Subject_taxid_URL'] = taxids.cat.rename_categories(
+        'https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id=' + taxids.cat.categories.astype(str))
+    df_concat.set_index(['Sample', 'Query'], inplace=True)
+    # df_concat is sorted by sample, query and descending bitscore so the first row per query is the top hit
+    df_top_results_per_query_seq = df_concat[~df_concat.index.duplicated(keep='first')]
     all_results_sheetname = 'All BLAST Results' if top_n_results <= 0 else f'Top {top_n_results} BLAST Results'
-    write_excel([('Top BLAST Results', df_top_results_per_query_seq.set_index(['Sample', 'Query'])),
-                 (all_results_sheetname, df_concat.set_index(['Sample', 'Query']))],
+    write_excel([('Top BLAST Results', df_top_results_per_query_seq),
+                 (all_results_sheetname, df_concat)],
                 output_dest=output_path,
                 output_df_index=True,
                 sheet_name_index=False,
-                freeze_panes=(1, 2))
+                freeze_panes=(1, 2),
+                compresslevel=compresslevel)
@@ -4,32 +4,46 @@ import logging
 import re
 import sys
 from pathlib import Path
-from typing import Dict, Tuple, Set
+from typing import Dict, Tuple, Set, Optional, Pattern
 
 import click
 
-from blast2xl.blast2xl import blast_tsv_to_df, output_xlsx_report
-from blast2xl.io import write_seqs_to_taxonomy_dirs
 from blast2xl.log import init_console_logger
+from blast2xl.util import COMPRESSION_SUFFIXES, cached_find_sample_files, find_sample_files
 
 logger = logging.getLogger(__name__)
 
 
+def compile_sample_name_regex(ctx: click.Context, param: click.Parameter, value: Optional[str]) -> Optional[Pattern]:
+    """Compile a sample name regex option value once, checking it has a group to extract the sample name"""
+    if not value:
+        return None
+    try:
+        regex = re.compile(value)
+    except re.error as ex:
+        raise click.BadParameter(f'Invalid regex pattern "{value}": {ex}')
+    if regex.groups < 1:
+        raise click.BadParameter(f'Regex pattern "{value}" must have a group to extract the sample name, e.g. "^(.+)"')
+    return regex
+
+
 @click.command()
 @click.option('-b', '--blast-tsv-dir', type=click.Path(exists=True), required=True,
               help='Input directory with BLAST tab-delimited (TSV) files. The base filename should be the sample '
                    'name. If a `--seq-dir` is provided, the BLAST TSV base filenames should match the FASTA base '
                    'filenames.')
-@click.option('-B', '--blast-tsv-sample-name-pattern', type=str, default=None,
+@click.option('-B', '--blast-tsv-sample-name-pattern', type=str, default=None, callback=compile_sample_name_regex,
               help='Regex pattern to extract sample name from BLAST TSV filename. '
                    'For example "^blastn-(.+)-vs-nt\\.tsv" to match "blastn-whatever-you-want-123-vs-nt.tsv" to '
                    'pull out sample name "whatever-you-want-123"')
 @click.option('--blast-tsv-extension', default='tsv', type=str,
-              help='Tabular BLAST filename extension (default: "tsv")')
+              help='Tabular BLAST filename extension (default: "tsv"). Compressed BLAST TSV files with an '
+                   'additional ".gz", ".bz2", ".zst" or ".lz4" extension (e.g. "sample.tsv.zst") are also found and '
+                   'decompressed while parsing.')
 @click.option('-s', '--seq-dir', type=click.Path(exists=True),
               help='Input directory with FASTA sequences from BLAST results. The base filename should be the sample '
                    'name and match the base filename for each BLAST result file.')
-@click.option('-S', '--seq-fasta-sample-name-pattern', type=str, default=None,
+@click.option('-S', '--seq-fasta-sample-name-pattern', type=str, default=None, callback=compile_sample_name_regex,
               help='Regex pattern to extract sample name from sequence FASTA filename. '
                    'For example "^(.+)-contigs\\.fasta" to match "my_sample1-contigs.fasta" to '
                    'pull out sample name "my_sample1"')
@@ -41,12 +55,21 @@ logger = logging.getLogger(__name__)
 @click.option('-o', '--output-xlsx', type=click.Path(),
               required=True,
               help='XLSX output file path')
+@click.option('--xlsx-compresslevel', type=click.IntRange(min=0, max=9), default=1,
+              help='Compression level (0-9) of the XLSX output. Higher levels give slightly smaller files but are '
+                   'slower to write (default: 1)')
 @click.option('-O', '--seq-outdir', type=click.Path(), default='taxonomy-sorted-sequences',
               help='Taxonomy organized sequence output directory')
 @click.option('--keep-orientation', is_flag=True,
               help='Keep original orientation of BLAST searched sequences when outputting to `--seq-outdir`. Default '
                    'is to save in "plus" strand orientation to keep sequence orientations consistent with most NCBI '
                    'deposited sequences.')
+@click.option('--cache/--no-cache', default=False,
+              help='Cache parsed BLAST TSV files as Parquet files ("<tsv>.parquet") next to each BLAST TSV file and '
+                   'read from the cache on subsequent runs if it is newer than the TSV. Sample files found in the '
+                   'input directories are also cached in "$XDG_CACHE_HOME/blast2xl" (default: no caching)')
+@click.option('-t', '--threads', type=click.IntRange(min=1), default=None,
+              help='Number of samples to process in parallel (default: number of CPUs)')
 @click.option('-v', '--verbose', default=0, count=True, help='Logging verbosity')
 def main(blast_tsv_dir,
          blast_tsv_sample_name_pattern,
@@ -56,8 +79,11 @@ def main(blast_tsv_dir,
          seq_fasta_extension,
          top_n_results,
          output_xlsx,
+         xlsx_compresslevel,
          seq_outdir,
          keep_orientation,
+         cache,
+         threads,
          verbose):
     """blast2xl: BLAST XLSX Report Creator
 
@@ -104,51 +130,61 @@ def main(blast_tsv_dir,
     using larger BLAST databases or other tools.
     """
 
+    # pandas, numpy and pyarrow are only imported once the arguments are parsed so that `--help` and usage
+    # errors are fast
+    from blast2xl.blast2xl import blast_tsv_to_df, output_xlsx_report
+    from blast2xl.io import write_seqs_to_taxonomy_dirs
+
     init_console_logger(verbose)
     blast_tsv_dir = Path(blast_tsv_dir)
 
     if blast_tsv_sample_name_pattern:
-        sample_name_regex = re.compile(blast_tsv_sample_name_pattern)
-        logger.debug(f'BLAST TSV sample_name_regex={sample_name_regex}')
-        sample_blast_tsv: Dict[str, Path] = {
-            sample_name_regex.sub(r'\1', x.name).replace(f'.{blast_tsv_extension}', ''): x for x in
-            blast_tsv_dir.glob(f'*.{blast_tsv_extension}')}
-    else:
-        sample_blast_tsv: Dict[str, Path] = {x.name.replace(f'.{blast_tsv_extension}', ''): x for x in
-                                             blast_tsv_dir.glob(f'*.{blast_tsv_extension}')}
+        logger.debug(f'BLAST TSV sample_name_regex={blast_tsv_sample_name_pattern}')
+    find_files = cached_find_sample_files if cache else find_sample_files
+    sample_blast_tsv: Dict[str, Path] = find_files(blast_tsv_dir,
+                                                   blast_tsv_extension,
+                                                   blast_tsv_sample_name_pattern,
+                                                   COMPRESSION_SUFFIXES)
     logger.info(f'Found {len(sample_blast_tsv)} BLAST tabular result files in "{blast_tsv_dir}"')
-    sample_dfs = blast_tsv_to_df(sample_blast_tsv, top_n_results)
-    output_xlsx_report(output_xlsx, sample_dfs, top_n_results)
+    sample_dfs = blast_tsv_to_df(sample_blast_tsv, top_n_results, cache=cache, threads=threads)
+    if cache:
+        # new Parquet caches next to the BLAST TSVs change the directory modification time so update the sample
+        # files manifest for the next run (only rescans the directory if the modification time changed)
+        cached_find_sample_files(blast_tsv_dir,
+                                 blast_tsv_extension,
+                                 blast_tsv_sample_name_pattern,
+                                 COMPRESSION_SUFFIXES)
+    output_xlsx_report(output_xlsx, sample_dfs, top_n_results, compresslevel=xlsx_compresslevel)
     if seq_dir:
         fastas, present_fastas = collect_fastas(sample_blast_tsv=sample_blast_tsv,
                                                 seq_dir=seq_dir,
                                                 seq_outdir=seq_outdir,
-                                                sample_name_pattern=seq_fasta_sample_name_pattern,
-                                                fasta_ext=seq_fasta_extension)
+                                                sample_name_regex=seq_fasta_sample_name_pattern,
+                                                fasta_ext=seq_fasta_extension,
+                                                cache=cache)
         path_seqoutdir = Path(seq_outdir)
         path_seqoutdir.mkdir(parents=True, exist_ok=True)
         write_seqs_to_taxonomy_dirs(fastas,
                                     path_seqoutdir,
                                     present_fastas,
                                     sample_dfs,
-                                    keep_orientation=keep_orientation)
+                                    keep_orientation=keep_orientation,
+                                    threads=threads)
 
 
 def collect_fastas(sample_blast_tsv: Dict[str, Path],
                    seq_dir: str,
                    seq_outdir: str,
-                   sample_name_pattern: str = None,
-                   fasta_ext: str = 'fasta') -> Tuple[Dict[str, Path], Set[str]]:
+                   sample_name_regex: Optional[Pattern] = None,
+                   fasta_ext: str = 'fasta',
+                   cache: bool = False) -> Tuple[Dict[str, Path], Set[str]]:
     seq_dir = Path(seq_dir)
     logger.info(f'FASTA sequence directory provided: "{seq_dir}". Taxonomy sorted sequences will be output'
                 f' to "{seq_outdir}".')
-    if sample_name_pattern:
-        sample_name_regex = re.compile(sample_name_pattern)
+    if sample_name_regex:
         logger.debug(f'FASTA sample_name_regex={sample_name_regex}')
-        fastas: Dict[str, Path] = {sample_name_regex.sub(r'\1', x.name).replace('.tsv', ''): x for x in
-                                   seq_dir.glob(f'*.{fasta_ext}')}
-    else:
-        fastas = {x.name.replace('.fasta', ''): x for x in seq_dir.glob(f'*.{fasta_ext}')}
+    find_files = cached_find_sample_files if cache else find_sample_files
+    fastas: Dict[str, Path] = find_files(seq_dir, fasta_ext, sample_name_regex)
     if len(fastas) == 0:
         logger.warning(
             f'FASTA sequence directory "{seq_dir}" contains no FASTA files matching glob pattern "*.{fasta_ext}"!')
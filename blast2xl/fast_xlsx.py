@@ -0,0 +1,239 @@
+# coding: utf-8
+"""Minimal streaming XLSX writer for blast2xl reports"""
+import math
+import numbers
+import os
+import re
+import zipfile
+from typing import Any, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+SPREADSHEETML_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIPS_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+# cell style (xf) indices in STYLES_XML
+HEADER_STYLE = 1
+HYPERLINK_STYLE = 2
+
+# number of rows to buffer before writing to the worksheet ZIP entry
+ROW_CHUNK_SIZE = 1000
+
+# Excel worksheet size limits
+MAX_ROWS = 1048576
+MAX_COLS = 16384
+
+STYLES_XML = (
+    f'{XML_DECLARATION}<styleSheet xmlns="{SPREADSHEETML_NS}">'
+    '<fonts count="3">'
+    '<font><sz val="11"/><name val="Calibri"/><family val="2"/><scheme val="minor"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/><family val="2"/><scheme val="minor"/></font>'
+    '<font><u/><sz val="11"/><color rgb="FF0563C1"/><name val="Calibri"/><family val="2"/><scheme val="minor"/></font>'
+    '</fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill>'
+    '</fills>'
+    '<borders count="2"><border><left/><right/><top/><bottom/><diagonal/></border>'
+    '<border><left style="thin"><color auto="1"/></left><right style="thin"><color auto="1"/></right>'
+    '<top style="thin"><color auto="1"/></top><bottom style="thin"><color auto="1"/></bottom><diagonal/></border>'
+    '</borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="3">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="1" xfId="0" applyFont="1" applyBorder="1" applyAlignment="1">'
+    '<alignment horizontal="center" vertical="top"/></xf>'
+    '<xf numFmtId="0" fontId="2" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+    '</cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+ROOT_RELS_XML = (
+    f'{XML_DECLARATION}<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    f'<Relationship Id="rId1" Type="{RELATIONSHIPS_NS}/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+# characters not allowed in XML 1.0
+ILLEGAL_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+class Sheet(NamedTuple):
+    name: str
+    header: Sequence[str]
+    rows: Iterable[Sequence[Any]]
+    col_widths: Sequence[float] = ()
+    freeze_panes: Tuple[int, int] = (0, 0)
+
+
+def col_letter(col: int) -> str:
+    """Get Excel column letters from 0-based column index (e.g. 0 -> "A", 27 -> "AB")"""
+    letters = ''
+    col += 1
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def xml_text(s: str) -> str:
+    return escape(ILLEGAL_XML_CHARS.sub('', s))
+
+
+def xml_attr(s: str) -> str:
+    """Escape a string for use in a double-quoted XML attribute value"""
+    return escape(ILLEGAL_XML_CHARS.sub('', s), {'"': '&quot;'})
+
+
+def str_cell_xml(value: str) -> str:
+    text = xml_text(value)
+    if value.startswith(('https://', 'http://')):
+        formula = xml_text(value.replace('"', '""'))
+        return f'<c s="{HYPERLINK_STYLE}" t="str"><f>HYPERLINK("{formula}")</f><v>{text}</v></c>'
+    if value != value.strip():
+        return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+    return f'<c t="inlineStr"><is><t>{text}</t></is></c>'
+
+
+def cell_xml(value: Any) -> str:
+    """Get SpreadsheetML XML for a cell value, with missing values as empty cells"""
+    if isinstance(value, str):
+        return str_cell_xml(value)
+    if value is None:
+        return '<c/>'
+    if isinstance(value, (bool, np.bool_)):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, numbers.Integral):
+        return f'<c><v>{int(value)}</v></c>'
+    if isinstance(value, numbers.Real):
+        value = float(value)
+        if math.isnan(value) or math.isinf(value):
+            return '<c/>'
+        return f'<c><v>{value!r}</v></c>'
+    return str_cell_xml(str(value))
+
+
+def excel_col_width(width: float) -> float:
+    """Convert a width in number of characters to an Excel column width including cell padding"""
+    if width < 1:
+        return int(width * 12 * 256) / 256
+    return int((width * 7 + 5) / 7 * 256) / 256
+
+
+def sheet_view_xml(freeze_panes: Tuple[int, int], tab_selected: bool) -> str:
+    selected = ' tabSelected="1"' if tab_selected else ''
+    row, col = freeze_panes
+    if row <= 0 and col <= 0:
+        return f'<sheetViews><sheetView{selected} workbookViewId="0"/></sheetViews>'
+    if row > 0 and col > 0:
+        active_pane = 'bottomRight'
+    elif row > 0:
+        active_pane = 'bottomLeft'
+    else:
+        active_pane = 'topRight'
+    splits = (f' xSplit="{col}"' if col > 0 else '') + (f' ySplit="{row}"' if row > 0 else '')
+    return (f'<sheetViews><sheetView{selected} workbookViewId="0">'
+            f'<pane{splits} topLeftCell="{col_letter(max(col, 0))}{max(row, 0) + 1}" activePane="{active_pane}" '
+            f'state="frozen"/><selection pane="{active_pane}"/></sheetView></sheetViews>')
+
+
+def write_sheet(zf: zipfile.ZipFile,
+                path: str,
+                sheet: Sheet,
+                shared_strings: Dict[str, int],
+                tab_selected: bool = False) -> int:
+    """Stream a worksheet XML file into the XLSX ZIP archive
+
+    Header strings are added to `shared_strings` (string to index). Returns the
+    number of rows written excluding the header row. Raises a ValueError if the
+    sheet exceeds MAX_ROWS rows or MAX_COLS columns.
+    """
+    if len(sheet.header) > MAX_COLS:
+        raise ValueError(f'Sheet "{sheet.name}" has {len(sheet.header)} columns. '
+                         f'Max Excel sheet size is {MAX_ROWS} rows and {MAX_COLS} columns.')
+    n_rows = 0
+    # sheet XML of very large sheets may be larger than the 2 GiB ZIP entry limit without ZIP64
+    with zf.open(path, 'w', force_zip64=True) as fh:
+        head = [XML_DECLARATION,
+                f'<worksheet xmlns="{SPREADSHEETML_NS}" xmlns:r="{RELATIONSHIPS_NS}">',
+                sheet_view_xml(sheet.freeze_panes, tab_selected),
+                '<sheetFormatPr defaultRowHeight="15"/>']
+        if sheet.col_widths:
+            head.append('<cols>')
+            head += [f'<col min="{i}" max="{i}" width="{excel_col_width(width)}" customWidth="1"/>'
+                     for i, width in enumerate(sheet.col_widths, start=1)]
+            head.append('</cols>')
+        head.append('<sheetData><row r="1">')
+        for name in map(str, sheet.header):
+            string_index = shared_strings.setdefault(name, len(shared_strings))
+            head.append(f'<c s="{HEADER_STYLE}" t="s"><v>{string_index}</v></c>')
+        head.append('</row>')
+        fh.write(''.join(head).encode('utf-8'))
+        chunk = []
+        for n_rows, row in enumerate(sheet.rows, start=1):
+            if n_rows + 1 > MAX_ROWS:
+                raise ValueError(f'Sheet "{sheet.name}" has more than {MAX_ROWS - 1} rows (excluding the header). '
+                                 f'Max Excel sheet size is {MAX_ROWS} rows and {MAX_COLS} columns.')
+            chunk.append(f'<row r="{n_rows + 1}">{"".join(map(cell_xml, row))}</row>')
+            if len(chunk) >= ROW_CHUNK_SIZE:
+                fh.write(''.join(chunk).encode('utf-8'))
+                chunk = []
+        chunk.append('</sheetData></worksheet>')
+        fh.write(''.join(chunk).encode('utf-8'))
+    return n_rows
+
+
+def write_report(path: str, sheets: Iterable[Sheet], compresslevel: int = 1) -> None:
+    """Write sheets to an XLSX file compressed at `compresslevel` (0-9)"""
+    shared_strings: Dict[str, int] = {}
+    sheet_names: List[str] = []
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+        try:
+            for i, sheet in enumerate(sheets, start=1):
+                write_sheet(zf, f'xl/worksheets/sheet{i}.xml', sheet, shared_strings, tab_selected=(i == 1))
+                sheet_names.append(sheet.name)
+        except Exception:
+            # do not leave an incomplete workbook behind
+            zf.close()
+            os.remove(path)
+            raise
+        n_sheets = len(sheet_names)
+        zf.writestr('[Content_Types].xml', ''.join(
+            [XML_DECLARATION,
+             '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">',
+             '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>',
+             '<Default Extension="xml" ContentType="application/xml"/>',
+             '<Override PartName="/xl/workbook.xml" '
+             'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>']
+            + [f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+               'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+               for i in range(1, n_sheets + 1)]
+            + ['<Override PartName="/xl/styles.xml" '
+               'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>',
+               '<Override PartName="/xl/sharedStrings.xml" '
+               'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>',
+               '</Types>']))
+        zf.writestr('_rels/.rels', ROOT_RELS_XML)
+        zf.writestr('xl/workbook.xml', ''.join(
+            [XML_DECLARATION,
+             f'<workbook xmlns="{SPREADSHEETML_NS}" xmlns:r="{RELATIONSHIPS_NS}">',
+             '<bookViews><workbookView/></bookViews><sheets>']
+            + [f'<sheet name="{xml_attr(name)}" sheetId="{i}" r:id="rId{i}"/>'
+               for i, name in enumerate(sheet_names, start=1)]
+            + ['</sheets></workbook>']))
+        zf.writestr('xl/_rels/workbook.xml.rels', ''.join(
+            [XML_DECLARATION,
+             '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">']
+            + [f'<Relationship Id="rId{i}" Type="{RELATIONSHIPS_NS}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+               for i in range(1, n_sheets + 1)]
+            + [f'<Relationship Id="rId{n_sheets + 1}" Type="{RELATIONSHIPS_NS}/styles" Target="styles.xml"/>',
+               f'<Relationship Id="rId{n_sheets + 2}" Type="{RELATIONSHIPS_NS}/sharedStrings" '
+               'Target="sharedStrings.xml"/>',
+               '</Relationships>']))
+        zf.writestr('xl/styles.xml', STYLES_XML)
+        zf.writestr('xl/sharedStrings.xml', ''.join(
+            [XML_DECLARATION,
+             f'<sst xmlns="{SPREADSHEETML_NS}" count="{len(shared_strings)}" uniqueCount="{len(shared_strings)}">']
+            + [f'<si><t>{xml_text(s)}</t></si>' for s in shared_strings]
+            + ['</sst>']))
@@ -0,0 +1,81 @@
+# coding: utf-8
+# simple_fasta_parser and reverse_complement are ported from Biopython's
+# Bio.SeqIO.FastaIO.SimpleFastaParser and Bio.Seq.reverse_complement and are
+# used under the terms of the BSD 3-Clause License:
+#
+# Copyright (c) 1999-2025, The Biopython Contributors
+# Copyright 2000 Andrew Dalke.
+# Copyright 2000-2002 Brad Chapman.
+# Copyright 2004-2005, 2010 by M de Hoon.
+# Copyright 2006-2023 by Peter Cock.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""Minimal FASTA parsing and DNA reverse complement
+
+Ported from Biopython (see the license notice above) so that Biopython is not
+needed for reading FASTA sequences as strings.
+"""
+from typing import Iterable, Iterator, Tuple
+
+# IUPAC ambiguous DNA complements (U is complemented as T)
+DNA_COMPLEMENTS = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'U': 'A',
+                   'M': 'K', 'R': 'Y', 'W': 'W', 'S': 'S', 'Y': 'R', 'K': 'M',
+                   'V': 'B', 'H': 'D', 'D': 'H', 'B': 'V', 'X': 'X', 'N': 'N'}
+
+DNA_COMPLEMENT_TABLE = str.maketrans({**DNA_COMPLEMENTS,
+                                      **{k.lower(): v.lower() for k, v in DNA_COMPLEMENTS.items()}})
+
+
+def simple_fasta_parser(handle: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """Iterate over FASTA records as (title, sequence) string tuples
+
+    The title is the header line without the leading ">" and the sequence has
+    all whitespace removed. Any text before the first record is skipped.
+    """
+    # handle may be a sequence of lines rather than a file object so make sure both loops share one iterator
+    handle = iter(handle)
+    for line in handle:
+        if line[0] == '>':
+            title = line[1:].rstrip()
+            break
+    else:
+        # no records, e.g. an empty file
+        return
+    lines = []
+    for line in handle:
+        if line[0] == '>':
+            yield title, ''.join(lines).replace(' ', '').replace('\r', '')
+            lines = []
+            title = line[1:].rstrip()
+            continue
+        lines.append(line.rstrip())
+    yield title, ''.join(lines).replace(' ', '').replace('\r', '')
+
+
+def reverse_complement(seq: str) -> str:
+    """Reverse complement a DNA sequence string with IUPAC ambiguity codes"""
+    return seq.translate(DNA_COMPLEMENT_TABLE)[::-1]
@@ -1,15 +1,24 @@
 # coding: utf-8
 import logging
+import mmap
+import multiprocessing
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
 from pathlib import Path
-from typing import Tuple, Iterator, List, Union, Dict, Set, Mapping
+from typing import Tuple, Iterator, Iterable, List, Union, Dict, Set, Mapping, Optional
 
 import numpy as np
 import pandas as pd
-from Bio import SeqIO
-from Bio.SeqRecord import SeqRecord
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import csv as pa_csv
 
-from blast2xl.util import invert_dict
+from blast2xl.fast_xlsx import Sheet, write_report
+from blast2xl.fasta import reverse_complement, simple_fasta_parser
+from blast2xl.log import init_console_logger_level
+from blast2xl.util import COMPRESSION_SUFFIXES
 
 logger = logging.getLogger(__name__)
 
@@ -28,16 +37,105 @@ BLAST_COLUMNS = [('qaccver', 'Query', 'category'),
                  ('qlen', 'Query_Length', 'uint32'),
                  ('slen', 'Subject_Length', 'uint32'),
                  # ('sstrand', 'Subject_Strand', 'category'),
-                 ('stitle', 'Subject_Title', str),
+                 ('stitle', 'Subject_Title', 'category'),
                  ('staxid', 'Subject_taxid', 'uint32'),
                  ('ssciname', 'Subject_Sciname', 'category')]
 
+# Parquet cache metadata key and value identifying the BLAST_COLUMNS the cache was written with
+PARQUET_CACHE_COLUMNS_KEY = b'blast2xl_blast_columns'
+PARQUET_CACHE_COLUMNS = repr([(x, y, str(z)) for x, y, z in BLAST_COLUMNS]).encode()
 
-def read_blast_tsv(blast_tsv_path: Union[str, Path]) -> pd.DataFrame:
-    return pd.read_table(blast_tsv_path,
-                         header=None,
-                         names=[y for x, y, z in BLAST_COLUMNS],
-                         dtype={y: z for x, y, z in BLAST_COLUMNS})
+FASTA_WRITE_BUFFER_SIZE = 1 << 20
+# max number of buffers per os.writev call (Linux IOV_MAX)
+FASTA_WRITEV_MAX_BUFFERS = 1024
+
+# number of DataFrame rows converted to Python objects at a time when writing XLSX worksheets
+ROWS_CHUNK_SIZE = 1 << 16
+
+ARROW_TYPES = {'category': pa.dictionary(pa.int32(), pa.string()),
+               float: pa.float64(),
+               'uint32': pa.uint32()}
+
+
+def parse_blast_tsv(blast_tsv_path: Union[str, Path]) -> pd.DataFrame:
+    """Read tabular BLAST output into a DataFrame with BLAST_COLUMNS names and dtypes
+
+    Compressed files (e.g. ".tsv.zst") are decompressed while reading. An empty file gives an empty DataFrame.
+    """
+    column_types = {y: ARROW_TYPES[z] for x, y, z in BLAST_COLUMNS}
+    try:
+        table = pa_csv.read_csv(str(blast_tsv_path),
+                                read_options=pa_csv.ReadOptions(column_names=list(column_types.keys()),
+                                                                block_size=64 << 20,
+                                                                use_threads=True),
+                                parse_options=pa_csv.ParseOptions(delimiter='\t'),
+                                convert_options=pa_csv.ConvertOptions(column_types=column_types,
+                                                                      strings_can_be_null=True))
+    except pa.ArrowInvalid:
+        if str(blast_tsv_path).endswith(COMPRESSION_SUFFIXES):
+            with pa.input_stream(str(blast_tsv_path)) as stream:
+                is_empty = len(stream.read(1)) == 0
+        else:
+            is_empty = os.stat(blast_tsv_path).st_size == 0
+        if not is_empty:
+            raise
+        logger.warning(f'No BLAST results in "{blast_tsv_path}"')
+        table = pa.schema(list(column_types.items())).empty_table()
+    df = table.to_pandas()
+    # pyarrow dictionary categories are in order of appearance; sort them so that sorting by category is lexical
+    for x, y, z in BLAST_COLUMNS:
+        if z == 'category':
+            df[y] = df[y].cat.reorder_categories(df[y].cat.categories.sort_values())
+    return df
+
+
+def read_blast_tsv(blast_tsv_path: Union[str, Path], cache: bool = False) -> pd.DataFrame:
+    """Read tabular BLAST output, optionally caching the parsed DataFrame in a "<blast_tsv_path>.parquet" file
+
+    The cache is used if it is at least as new as the TSV and was written for the current BLAST_COLUMNS.
+    """
+    blast_tsv_path = Path(blast_tsv_path)
+    parquet_path = blast_tsv_path.with_name(blast_tsv_path.name + '.parquet')
+    if cache and parquet_path.exists() and parquet_path.stat().st_mtime >= blast_tsv_path.stat().st_mtime:
+        metadata = pq.read_schema(parquet_path).metadata or {}
+        if metadata.get(PARQUET_CACHE_COLUMNS_KEY) == PARQUET_CACHE_COLUMNS:
+            logger.debug(f'Reading cached BLAST results from "{parquet_path}"')
+            return pd.read_parquet(parquet_path, engine='pyarrow')
+        logger.info(f'Cached BLAST results "{parquet_path}" have different columns or dtypes. Re-parsing '
+                    f'"{blast_tsv_path}".')
+    df = parse_blast_tsv(blast_tsv_path)
+    if cache:
+        try:
+            table = pa.Table.from_pandas(df)
+            table = table.replace_schema_metadata({**table.schema.metadata,
+                                                   PARQUET_CACHE_COLUMNS_KEY: PARQUET_CACHE_COLUMNS})
+            pq.write_table(table, parquet_path, compression='zstd', compression_level=3)
+            logger.debug(f'Cached parsed BLAST results to "{parquet_path}"')
+        except OSError as ex:
+            logger.warning(f'Could not cache parsed BLAST results to "{parquet_path}": {ex}')
+    return df
+
+
+def get_max_str_len(s: pd.Series) -> int:
+    """Get max string length of Series values, ignoring missing values"""
+    if s.empty:
+        return 0
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        s = s.cat.categories.to_series()
+    if pd.api.types.is_bool_dtype(s.dtype):
+        return len(str(False))
+    if pd.api.types.is_integer_dtype(s.dtype):
+        return max(len(str(s.max())), len(str(s.min())))
+    if pd.api.types.is_float_dtype(s.dtype):
+        abs_max = s.abs().max()
+        if pd.isna(abs_max):
+            return 0
+        if not np.isfinite(abs_max):
+            return len(str(-abs_max))
+        # sign, decimal point and a few decimal places
+        return len(str(int(abs_max))) + 6
+    max_len = s.dropna().astype(str).str.len().max()
+    return 0 if pd.isna(max_len) else int(max_len)
 
 
 def get_col_widths(df: pd.DataFrame, index: bool = False, pad_width: int = 2) -> Iterator[int]:
@@ -47,98 +145,244 @@ def get_col_widths(df: pd.DataFrame, index: bool = False, pad_width: int = 2) ->
     """
     if index:
         for i, idx_name in enumerate(df.index.names):
-            idx_max = max([len(str(s[i] if len(s) > 1 else s)) for s in df.index.values] + [len(str(idx_name))])
+            idx_max = max(get_max_str_len(pd.Series(df.index.get_level_values(i))), len(str(idx_name)))
             yield idx_max + pad_width
     for c in df.columns:
         # get max length of column contents and length of column header
-        yield np.max([df[c].astype(str).str.len().max() + 1, len(c) + 1]) + pad_width
+        yield max(get_max_str_len(df[c]) + 1, len(c) + 1) + pad_width
+
+
+def iter_df_rows(df: pd.DataFrame, index: bool = False) -> Iterator[tuple]:
+    """Yield the header and then each row of a DataFrame as a tuple, with missing values as None
+
+    Index levels are output as the first columns if `index` is True.
+    """
+    columns = [df[c] for c in df.columns]
+    header = [str(c) for c in df.columns]
+    if index:
+        # iterate over index levels directly rather than copying the whole DataFrame with reset_index
+        columns = [df.index.get_level_values(i) for i in range(df.index.nlevels)] + columns
+        header = [str(x) for x in df.index.names] + header
+    yield tuple(header)
+    arrays = [x.to_numpy() for x in columns]
+    for start in range(0, df.shape[0], ROWS_CHUNK_SIZE):
+        chunk_columns = []
+        for arr in arrays:
+            chunk = arr[start:start + ROWS_CHUNK_SIZE]
+            values = chunk.tolist()
+            missing = pd.isna(chunk)
+            if missing.any():
+                values = [None if is_missing else v for v, is_missing in zip(values, missing)]
+            chunk_columns.append(values)
+        yield from zip(*chunk_columns)
 
 
 def write_excel(name_dfs: List[Tuple[str, pd.DataFrame]],
                 output_dest: str,
                 output_df_index: bool = False,
                 sheet_name_index: bool = True,
-                freeze_panes: Tuple[int, int] = (1, 1)) -> None:
+                freeze_panes: Tuple[int, int] = (1, 1),
+                compresslevel: int = 1) -> None:
+    """Write DataFrames to worksheets in an XLSX workbook"""
     if not output_dest.endswith('.xlsx'):
         output_dest += '.xlsx'
-    logger.info('Starting to write Pandas DataFrames to worksheets in XLSX workbook ("{output_dest}")')
-    with pd.ExcelWriter(output_dest, engine='xlsxwriter') as writer:
-        forbidden_characters = re.compile(r'[\\:/?*\[\]]+')
-        idx = 1
-        for name_df in name_dfs:
-            if not isinstance(name_df, (list, tuple)):
-                logger.error(f'Input "{name_df}" is not a list or tuple (type="{type(name_df)}"). Skipping...')
-                continue
-            sheetname, df = name_df
-            fixed_sheetname = forbidden_characters.sub('_', sheetname)
-            # fixed max number of characters in sheet name due to compatibility
-            if sheet_name_index:
-                max_chars = 28
-                fixed_sheetname = f'{idx}_{fixed_sheetname[:max_chars]}'
-            else:
-                max_chars = 31
-                fixed_sheetname = fixed_sheetname[:max_chars]
-
-            if len(fixed_sheetname) > max_chars:
-                logger.warning(f'Sheetname "{fixed_sheetname}" is >= {max_chars} characters so may be truncated '
-                               f'(n={len(fixed_sheetname)})')
-
-            logger.info(f'Writing table to Excel sheet "{fixed_sheetname}"')
-            df.to_excel(writer,
-                        sheet_name=fixed_sheetname,
-                        index=output_df_index,
-                        freeze_panes=freeze_panes)
-            worksheet = writer.book.get_worksheet_by_name(fixed_sheetname)
-            for i, width in enumerate(get_col_widths(df, index=output_df_index)):
-                worksheet.set_column(i, i, width)
-            idx += 1
+    logger.info(f'Starting to write Pandas DataFrames to worksheets in XLSX workbook ("{output_dest}")')
+    forbidden_characters = re.compile(r'[\\:/?*\[\]]+')
+    sheets = []
+    idx = 1
+    for name_df in name_dfs:
+        if not isinstance(name_df, (list, tuple)):
+            logger.error(f'Input "{name_df}" is not a list or tuple (type="{type(name_df)}"). Skipping...')
+            continue
+        sheetname, df = name_df
+        fixed_sheetname = forbidden_characters.sub('_', sheetname)
+        # fixed max number of characters in sheet name due to compatibility
+        if sheet_name_index:
+            max_chars = 28
+            fixed_sheetname = f'{idx}_{fixed_sheetname[:max_chars]}'
+        else:
+            max_chars = 31
+            fixed_sheetname = fixed_sheetname[:max_chars]
+
+        if len(fixed_sheetname) > max_chars:
+            logger.warning(f'Sheetname "{fixed_sheetname}" is >= {max_chars} characters so may be truncated '
+                           f'(n={len(fixed_sheetname)})')
+
+        rows = iter_df_rows(df, index=output_df_index)
+        sheets.append(Sheet(name=fixed_sheetname,
+                            header=next(rows),
+                            rows=rows,
+                            col_widths=list(get_col_widths(df, index=output_df_index)),
+                            freeze_panes=freeze_panes))
+        idx += 1
+    write_report(output_dest, sheets, compresslevel=compresslevel)
     logger.info('Done writing worksheets to spreadsheet "%s".', output_dest)
 
 
-def write_seqs_to_taxonomy_dirs(fastas: Dict[str, Path],
-                                path_seqoutdir: Path,
-                                present_fastas: Set[str],
-                                sample_dfs: Dict[str, pd.DataFrame],
-                                keep_orientation: bool = False):
-    for sample in present_fastas:
-        df = sample_dfs[sample]
-        df_top: pd.DataFrame = df.groupby('Query').first()
-        qid_dirname_series: pd.Series = df_top.Subject_Sciname.str.replace(r'\W', '_') \
-                                        + '-' + df_top.Subject_taxid.astype(str)
-        query_dirname: Mapping[str, str] = qid_dirname_series.to_dict()
-        dirname_queries = invert_dict(query_dirname)
-        recs: Dict[str, SeqRecord] = {r.id: r for r in SeqIO.parse(str(fastas[sample]), 'fasta')}
-        missing_recs = set(recs.keys()) - set(query_dirname.keys())
-        if not keep_orientation:
-            need_revcomp = set(df_top.index.values[df_top.Subject_Start > df_top.Subject_End])
-            out = {}
-            for rid, r in recs.items():
-                if rid in need_revcomp:
-                    r_desc = r.description
-                    r_name = r.name
-                    r = r.reverse_complement()
-                    r.id = rid
-                    r.name = r_name
-                    r.description = f'{r_desc}|REVCOMP'
-                if rid not in missing_recs:
-                    rid_blast = df_top.loc[rid, :].to_dict()
-                    r.description += (f'|TOP_ACC="{rid_blast["Subject"]}"'
-                                      f'|TOP_%ID={rid_blast["Percent_Identity"]:.2f}'
-                                      f'|TOP_ALN_LEN={rid_blast["Alignment_Length"]}'
-                                      f'|TOP_NAME="{rid_blast["Subject_Title"]}"')
-                    # r.description += f'|{rid_blast}'
-                out[rid] = r
-            recs = out
+def replace_non_word_chars(s: pd.Series, repl: str = '_') -> pd.Series:
+    """Replace non-word characters in Series string values"""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        categories = s.cat.categories
+        return s.map(dict(zip(categories, categories.str.replace(r'\W', repl, regex=True)))).astype(object)
+    return s.str.replace(r'\W', repl, regex=True)
+
+
+def build_fasta_offset_index(buf: Union[bytes, mmap.mmap]) -> Dict[str, Tuple[int, int]]:
+    """Map FASTA record IDs to the (start, end) byte offsets of each record"""
+    offsets = {}
+    rid = None
+    start = 0
+    pos = 0 if buf[:1] == b'>' else buf.find(b'\n>')
+    if pos > 0:
+        pos += 1
+    while pos != -1:
+        header_end = buf.find(b'\n', pos)
+        if header_end == -1:
+            header_end = len(buf)
+        if rid is not None:
+            offsets[rid] = (start, pos)
+        rid = (buf[pos + 1:header_end].split(None, 1) or [b''])[0].decode()
+        start = pos
+        pos = buf.find(b'\n>', header_end)
+        if pos != -1:
+            pos += 1
+    if rid is not None:
+        offsets[rid] = (start, len(buf))
+    return offsets
+
+
+def iter_fasta_records(buf: Union[bytes, mmap.mmap],
+                       offsets: Mapping[str, Tuple[int, int]],
+                       rids: Iterable[str],
+                       need_revcomp: Set[str],
+                       desc_suffixes: Mapping[str, str]) -> Iterator[Tuple[str, str]]:
+    """Yield (title, sequence) of FASTA records by ID, reverse complemented and with top hit info if needed"""
+    for rid in rids:
+        start, end = offsets[rid]
+        title, seq = next(simple_fasta_parser(StringIO(buf[start:end].decode())))
+        if rid in need_revcomp:
+            seq = reverse_complement(seq)
+            title += '|REVCOMP'
+        yield title + desc_suffixes.get(rid, ''), seq
+
+
+def wrap_seq(seq: str, line_width: int = 60) -> str:
+    """Wrap sequence into newline terminated lines of at most `line_width` characters"""
+    return ''.join(seq[i:i + line_width] + '\n' for i in range(0, len(seq), line_width))
+
+
+def write_buffers(fd: int, bufs: List[bytes]) -> None:
+    """Write all buffers to a file descriptor"""
+    if hasattr(os, 'writev'):
+        n_bytes = os.writev(fd, bufs)
+        if n_bytes == sum(map(len, bufs)):
+            return
+        data = memoryview(b''.join(bufs))[n_bytes:]
+    else:
+        data = memoryview(b''.join(bufs))
+    while data:
+        data = data[os.write(fd, data):]
+
 
+def write_fasta(path: Path, recs: Iterable[Tuple[str, str]], line_width: int = 60) -> int:
+    """Write (title, sequence) records to a FASTA file, returning the number of records written"""
+    n_written = 0
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        bufs: List[bytes] = []
+        n_bytes = 0
+        for title, seq in recs:
+            buf = f'>{title}\n{wrap_seq(seq, line_width)}'.encode()
+            bufs.append(buf)
+            n_bytes += len(buf)
+            n_written += 1
+            if len(bufs) >= FASTA_WRITEV_MAX_BUFFERS or n_bytes >= FASTA_WRITE_BUFFER_SIZE:
+                write_buffers(fd, bufs)
+                bufs = []
+                n_bytes = 0
+        if bufs:
+            write_buffers(fd, bufs)
+    finally:
+        os.close(fd)
+    return n_written
+
+
+def write_sample_seqs_to_taxonomy_dirs(sample: str,
+                                       fasta_path: Path,
+                                       df_top: pd.DataFrame,
+                                       path_seqoutdir: Path,
+                                       keep_orientation: bool = False):
+    """Write sample sequences to directories named after the scientific name and taxid of their top BLAST hit
+
+    `df_top` should contain the top BLAST result for each query sequence indexed by query sequence ID.
+    Queries with a top hit without scientific name or taxid (BLAST outputs "N/A") are written to the
+    "unclassified-0" directory or "unclassified-{taxid}" if only the scientific name is missing.
+    """
+    missing_taxonomy = df_top.Subject_Sciname.isna() | df_top.Subject_taxid.isna()
+    if missing_taxonomy.any():
+        logger.warning(f'Sample "{sample}" has {missing_taxonomy.sum()} queries with a top BLAST hit without '
+                       f'scientific name or taxid. Writing their sequences to "unclassified" directories.')
+    qid_dirname_series: pd.Series = replace_non_word_chars(df_top.Subject_Sciname).fillna('unclassified') \
+        + '-' + df_top.Subject_taxid.fillna(0).astype('uint32').astype(str)
+    dirname_queries: Dict[str, List[str]] = {dirname: queries.index.tolist()
+                                             for dirname, queries in qid_dirname_series.groupby(qid_dirname_series)}
+    need_revcomp: Set[str] = set()
+    desc_suffixes: Dict[str, str] = {}
+    if not keep_orientation:
+        need_revcomp = set(df_top.index.values[df_top.Subject_Start > df_top.Subject_End])
+        # build top hit description suffixes for all queries at once rather than per record
+        desc_suffixes = ('|TOP_ACC="' + df_top.Subject.astype(str)
+                         + '"|TOP_%ID=' + df_top.Percent_Identity.map('{:.2f}'.format)
+                         + '|TOP_ALN_LEN=' + df_top.Alignment_Length.astype(str)
+                         + '|TOP_NAME="' + df_top.Subject_Title.astype(str) + '"').to_dict()
+    if fasta_path.stat().st_size == 0:
+        logger.warning(f'Sample "{sample}" FASTA file "{fasta_path}" is empty!')
+        return
+    # memory-map the FASTA and index record offsets so records are only read from disk when written out
+    with open(fasta_path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offsets = build_fasta_offset_index(mm)
+        missing_recs = set(offsets.keys()) - set(qid_dirname_series.index)
         if len(missing_recs) > 0:
             unclassified_dir = path_seqoutdir / sample / '0-no-hits'
             unclassified_dir.mkdir(parents=True, exist_ok=True)
             sample_seqout = unclassified_dir / f'{sample}.fasta'
-            n_written = SeqIO.write([recs[r] for r in missing_recs], sample_seqout, 'fasta')
+            n_written = write_fasta(sample_seqout,
+                                    iter_fasta_records(mm, offsets, missing_recs, need_revcomp, desc_suffixes))
             logger.info(f'Wrote {n_written} sequences to "{sample_seqout}"')
         for dirname, queries in dirname_queries.items():
             path_sciname = path_seqoutdir / sample / dirname
             path_sciname.mkdir(parents=True, exist_ok=True)
             sample_seqout = path_sciname / f'{sample}.fasta'
-            n_written = SeqIO.write([recs[q] for q in queries], sample_seqout, 'fasta')
+            n_written = write_fasta(sample_seqout,
+                                    iter_fasta_records(mm, offsets, queries, need_revcomp, desc_suffixes))
             logger.info(f'Wrote {n_written} sequences to "{sample_seqout}"')
+
+
+def write_seqs_to_taxonomy_dirs(fastas: Dict[str, Path],
+                                path_seqoutdir: Path,
+                                present_fastas: Set[str],
+                                sample_dfs: Dict[str, pd.DataFrame],
+                                keep_orientation: bool = False,
+                                threads: Optional[int] = None):
+    """Write sequences of each sample to taxonomy directories, processing samples in parallel"""
+    sample_df_tops = {sample: sample_dfs[sample].drop_duplicates(subset='Query', keep='first').set_index('Query')
+                      for sample in sorted(present_fastas)}
+    if threads == 1 or len(sample_df_tops) <= 1:
+        for sample, df_top in sample_df_tops.items():
+            write_sample_seqs_to_taxonomy_dirs(sample, fastas[sample], df_top, path_seqoutdir, keep_orientation)
+        return
+    # spawn workers rather than forking this process after pyarrow has started its thread pool; spawned workers
+    # do not inherit the console logging configuration
+    with ProcessPoolExecutor(max_workers=threads,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_console_logger_level,
+                             initargs=(logging.getLogger().getEffectiveLevel(),)) as executor:
+        futures = [executor.submit(write_sample_seqs_to_taxonomy_dirs,
+                                   sample,
+                                   fastas[sample],
+                                   df_top,
+                                   path_seqoutdir,
+                                   keep_orientation)
+                   for sample, df_top in sample_df_tops.items()]
+        for future in futures:
+            future.result()
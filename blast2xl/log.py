@@ -8,4 +8,9 @@ def init_console_logger(logging_verbosity=0):
     if logging_verbosity > (len(logging_levels) - 1):
         logging_verbosity = 3
     lvl = logging_levels[logging_verbosity]
-    logging.basicConfig(format=LOG_FORMAT, level=lvl, style='{')
+    init_console_logger_level(lvl)
+
+
+def init_console_logger_level(level: int):
+    """Configure console logging at a logging level, e.g. in worker processes with the main process root level"""
+    logging.basicConfig(format=LOG_FORMAT, level=level, style='{')
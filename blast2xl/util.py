@@ -1,4 +1,15 @@
-from typing import Mapping, Dict, Any, Set
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import Mapping, Dict, Any, Set, Optional, Pattern, Union, Sequence
+
+logger = logging.getLogger(__name__)
+
+# compressed file extensions that pyarrow transparently decompresses when reading files
+COMPRESSION_SUFFIXES = ('.gz', '.bz2', '.zst', '.lz4')
 
 
 def invert_dict(d: Mapping) -> Dict[Any, Set]:
@@ -9,3 +20,77 @@ def invert_dict(d: Mapping) -> Dict[Any, Set]:
         else:
             out[v] = {k}
     return out
+
+
+def find_sample_files(dirpath: Union[str, Path],
+                      ext: str,
+                      sample_name_regex: Optional[Pattern] = None,
+                      compression_suffixes: Sequence[str] = ()) -> Dict[str, Path]:
+    """Find files in a directory with a filename extension and map them by sample name
+
+    The sample name is the filename without extension or, if a regex is provided,
+    the first capture group of the regex in the filename. Files with the
+    extension followed by one of `compression_suffixes` (e.g. "sample.tsv.zst")
+    are also found.
+    """
+    suffix = f'.{ext}'
+    compressed_suffixes = tuple(suffix + x for x in compression_suffixes)
+    out = {}
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if not (entry.name.endswith((suffix,) + compressed_suffixes) and entry.is_file()):
+                continue
+            name = entry.name
+            for compression_suffix in compression_suffixes:
+                if name.endswith(suffix + compression_suffix):
+                    name = name[:-len(compression_suffix)]
+                    break
+            sample = sample_name_regex.sub(r'\1', name) if sample_name_regex else name
+            if sample.endswith(suffix):
+                sample = sample[:-len(suffix)]
+            if sample in out:
+                logger.warning(f'Multiple files found for sample "{sample}". Using "{entry.path}" instead of '
+                               f'"{out[sample]}".')
+            out[sample] = Path(entry.path)
+    return out
+
+
+def user_cache_dir() -> Path:
+    """Get the blast2xl user cache directory ("$XDG_CACHE_HOME/blast2xl" or "~/.cache/blast2xl")"""
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'blast2xl'
+
+
+def cached_find_sample_files(dirpath: Union[str, Path],
+                             ext: str,
+                             sample_name_regex: Optional[Pattern] = None,
+                             compression_suffixes: Sequence[str] = (),
+                             cache_dir: Optional[Path] = None) -> Dict[str, Path]:
+    """Find sample files like `find_sample_files`, caching the result in a pickled manifest file
+
+    The manifest is only used while the directory modification time is unchanged.
+    """
+    dirpath = Path(dirpath).resolve()
+    key = (str(dirpath), ext, tuple(compression_suffixes), sample_name_regex.pattern if sample_name_regex else None)
+    dir_mtime_ns = os.stat(dirpath).st_mtime_ns
+    cache_dir = cache_dir or user_cache_dir()
+    manifest_path = cache_dir / f'manifest-{hashlib.sha1(repr(key).encode()).hexdigest()}.pkl'
+    try:
+        with open(manifest_path, 'rb') as fh:
+            cached_key, cached_mtime_ns, sample_files = pickle.load(fh)
+        if cached_key == key and cached_mtime_ns == dir_mtime_ns:
+            logger.debug(f'Read sample files in "{dirpath}" from cached manifest "{manifest_path}"')
+            return sample_files
+    except FileNotFoundError:
+        pass
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError) as ex:
+        logger.debug(f'Could not read cached manifest "{manifest_path}": {ex}')
+    sample_files = find_sample_files(dirpath, ext, sample_name_regex, compression_suffixes)
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=cache_dir, suffix='.tmp', delete=False) as fh:
+            pickle.dump((key, dir_mtime_ns, sample_files), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fh.name, manifest_path)
+        logger.debug(f'Cached sample files in "{dirpath}" to manifest "{manifest_path}"')
+    except OSError as ex:
+        logger.warning(f'Could not cache sample files manifest to "{manifest_path}": {ex}')
+    return sample_files
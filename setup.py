@@ -12,8 +12,7 @@ with open('HISTORY.rst') as history_file:
 
 requirements = ['Click>=7.0',
                 'pandas>=0.25.0',
-                'biopython>=1.73',
-                'xlsxwriter']
+                'pyarrow>=1.0.0']
 
 setup_requirements = ['pytest-runner', ]
 
@@ -22,14 +21,13 @@ test_requirements = ['pytest>=3', ]
 setup(
     author="Peter Kruczkiewicz",
     author_email='peter.kruczkiewicz@canada.ca',
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
     ],
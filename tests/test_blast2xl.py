@@ -2,12 +2,25 @@
 
 """Tests for `blast2xl` package."""
 
+import os
+import re
+import shutil
+import zipfile
 from os.path import abspath
 from pathlib import Path
+from xml.etree import ElementTree
 
+import numpy as np
+import pandas as pd
+import pytest
 from click.testing import CliRunner
 
-from blast2xl import cli
+from blast2xl import cli, fast_xlsx, io, util
+from blast2xl.blast2xl import top_n_per_group
+from blast2xl.fast_xlsx import Sheet, write_report
+from blast2xl.fasta import reverse_complement, simple_fasta_parser
+from blast2xl.io import build_fasta_offset_index
+from blast2xl.util import COMPRESSION_SUFFIXES, cached_find_sample_files, find_sample_files
 
 
 def test_command_line_interface():
@@ -46,3 +59,200 @@ def test_command_line_interface():
         assert Path(excel_report).exists()
         assert Path(excel_report).stat().st_size > 0
 
+
+def test_build_fasta_offset_index():
+    """Test FASTA record offsets are found from header lines only."""
+    fasta = b'>seq1 first\nACGT\nAC\n\n>seq2\n>seq3 third\nTTTT'
+    offsets = build_fasta_offset_index(fasta)
+    assert list(offsets.keys()) == ['seq1', 'seq2', 'seq3']
+    assert fasta[slice(*offsets['seq1'])] == b'>seq1 first\nACGT\nAC\n\n'
+    assert fasta[slice(*offsets['seq2'])] == b'>seq2\n'
+    assert fasta[slice(*offsets['seq3'])] == b'>seq3 third\nTTTT'
+    assert build_fasta_offset_index(b'') == {}
+
+
+def test_fast_xlsx_write_report(tmp_path):
+    """Test streamed XLSX output is well-formed with expected cell values."""
+    xlsx_path = str(tmp_path / 'report.xlsx')
+    write_report(xlsx_path, [Sheet(name='Sheet "<1>"',
+                                   header=['a', 'b', 'c'],
+                                   rows=iter([('x & y', 1, 2.5), (None, float('nan'), 'https://example.com/?a=1&b=2')]),
+                                   col_widths=[5, 10, 20],
+                                   freeze_panes=(1, 1)),
+                             Sheet(name='Sheet2', header=['a', 'd'], rows=[(True, 'z ')])])
+    ns = {'x': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+    with zipfile.ZipFile(xlsx_path) as zf:
+        xml_files = {name: ElementTree.fromstring(zf.read(name)) for name in zf.namelist()}
+    workbook = xml_files['xl/workbook.xml']
+    assert [x.get('name') for x in workbook.iterfind('x:sheets/x:sheet', ns)] == ['Sheet "<1>"', 'Sheet2']
+    shared_strings = [x.text for x in xml_files['xl/sharedStrings.xml'].iterfind('x:si/x:t', ns)]
+    assert shared_strings == ['a', 'b', 'c', 'd']
+    rows = list(xml_files['xl/worksheets/sheet1.xml'].iterfind('x:sheetData/x:row', ns))
+    assert len(rows) == 3
+    assert [c.findtext('x:v', namespaces=ns) for c in rows[0]] == ['0', '1', '2']
+    assert rows[1][0].findtext('x:is/x:t', namespaces=ns) == 'x & y'
+    assert [c.findtext('x:v', namespaces=ns) for c in rows[1][1:]] == ['1', '2.5']
+    assert len(rows[2]) == 3
+    assert rows[2][2].findtext('x:f', namespaces=ns) == 'HYPERLINK("https://example.com/?a=1&b=2")'
+    pane = xml_files['xl/worksheets/sheet1.xml'].find('x:sheetViews/x:sheetView/x:pane', ns)
+    assert (pane.get('xSplit'), pane.get('ySplit'), pane.get('topLeftCell')) == ('1', '1', 'B2')
+    rows = list(xml_files['xl/worksheets/sheet2.xml'].iterfind('x:sheetData/x:row', ns))
+    assert [c.findtext('x:v', namespaces=ns) for c in rows[0]] == ['0', '3']
+    assert rows[1][0].get('t') == 'b'
+    assert rows[1][1].findtext('x:is/x:t', namespaces=ns) == 'z '
+
+
+def test_top_n_per_group():
+    """Test top scoring rows are selected per group with ties kept in original order."""
+    codes = np.array([0, 1, 0, 0, 1, 2, 0])
+    scores = np.array([1.0, 5.0, 3.0, 3.0, 2.0, 0.5, 2.0])
+    assert top_n_per_group(codes, scores, 1).tolist() == [2, 1, 5]
+    assert top_n_per_group(codes, scores, 2).tolist() == [2, 3, 1, 4, 5]
+    assert top_n_per_group(codes[:0], scores[:0], 2).tolist() == []
+
+
+def test_find_sample_files_compressed(tmp_path):
+    """Test compressed files are found and their sample names have the compression suffix stripped."""
+    for name in ['blastn-a-vs-nt.tsv', 'blastn-b-vs-nt.tsv.zst', 'blastn-c-vs-nt.tsv.gz', 'blastn-d-vs-nt.txt.gz']:
+        (tmp_path / name).touch()
+    sample_files = find_sample_files(tmp_path, 'tsv', compression_suffixes=COMPRESSION_SUFFIXES)
+    assert sorted(sample_files.keys()) == ['blastn-a-vs-nt', 'blastn-b-vs-nt', 'blastn-c-vs-nt']
+    assert sorted(find_sample_files(tmp_path, 'tsv').keys()) == ['blastn-a-vs-nt']
+    for pattern in [r'^blastn-(.+)-vs-nt\.tsv', r'^blastn-(.+)-vs-nt.*']:
+        sample_files = find_sample_files(tmp_path, 'tsv', re.compile(pattern), COMPRESSION_SUFFIXES)
+        assert sorted(sample_files.keys()) == ['a', 'b', 'c']
+
+
+def test_read_blast_tsv_cache(tmp_path, monkeypatch):
+    """Test parsed BLAST results are cached in a Parquet file and re-parsed when the TSV is newer."""
+    tsv_path = tmp_path / 'blastn-FMDV-vs-nt.tsv'
+    shutil.copy('tests/data/blast_tsv/blastn-FMDV-vs-nt.tsv', tsv_path)
+    parquet_path = tmp_path / 'blastn-FMDV-vs-nt.tsv.parquet'
+    df = io.read_blast_tsv(tsv_path, cache=True)
+    assert parquet_path.exists()
+
+    def fail_parse(path):
+        raise AssertionError(f'"{path}" parsed instead of read from cache')
+
+    with monkeypatch.context() as m:
+        m.setattr(io, 'parse_blast_tsv', fail_parse)
+        df_cached = io.read_blast_tsv(tsv_path, cache=True)
+    pd.testing.assert_frame_equal(df, df_cached)
+    assert (df_cached['Query'].cat.categories == df_cached['Query'].cat.categories.sort_values()).all()
+
+    lines = tsv_path.read_text().splitlines(keepends=True)
+    tsv_path.write_text(''.join(lines[:3]))
+    parquet_mtime = parquet_path.stat().st_mtime
+    os.utime(tsv_path, (parquet_mtime + 10, parquet_mtime + 10))
+    df_reparsed = io.read_blast_tsv(tsv_path, cache=True)
+    assert df_reparsed.shape[0] == 3
+    assert pd.read_parquet(parquet_path).shape[0] == 3
+
+    # caches written for other BLAST columns or dtypes are not used
+    df_reparsed.astype({'Subject_Title': object}).to_parquet(parquet_path)
+    os.utime(tsv_path, (parquet_mtime, parquet_mtime))
+    df_reparsed = io.read_blast_tsv(tsv_path, cache=True)
+    assert isinstance(df_reparsed['Subject_Title'].dtype, pd.CategoricalDtype)
+    with monkeypatch.context() as m:
+        m.setattr(io, 'parse_blast_tsv', fail_parse)
+        pd.testing.assert_frame_equal(io.read_blast_tsv(tsv_path, cache=True), df_reparsed)
+
+
+def test_missing_taxonomy_sequences_unclassified(tmp_path):
+    """Test sequences with a top hit without scientific name or taxid are written to an "unclassified" dir."""
+    blast_tsv_dir = tmp_path / 'blast_tsv'
+    blast_tsv_dir.mkdir()
+    with open('tests/data/blast_tsv/blastn-FMDV-vs-nt.tsv') as fin, \
+            open(blast_tsv_dir / 'blastn-FMDV-vs-nt.tsv', 'w') as fout:
+        for line in fin:
+            fields = line.rstrip('\n').split('\t')
+            fields[15] = 'N/A'
+            fields[16] = 'N/A'
+            fout.write('\t'.join(fields) + '\n')
+    seq_outdir = tmp_path / 'seq-outdir'
+    result = CliRunner().invoke(cli.main, ['--blast-tsv-dir', str(blast_tsv_dir),
+                                           '--blast-tsv-sample-name-pattern', r'^blastn-(.+)-vs-nt.*',
+                                           '--seq-dir', abspath('tests/data/fastas'),
+                                           '-o', str(tmp_path / 'report.xlsx'),
+                                           '-O', str(seq_outdir)])
+    assert result.exit_code == 0
+    with open('tests/data/fastas/FMDV.fasta') as fh:
+        n_input_seqs = sum(line.startswith('>') for line in fh)
+    assert [p.name for p in (seq_outdir / 'FMDV').iterdir()] == ['unclassified-0']
+    with open(seq_outdir / 'FMDV' / 'unclassified-0' / 'FMDV.fasta') as fh:
+        assert sum(line.startswith('>') for line in fh) == n_input_seqs
+
+
+def fail_find_sample_files(*args, **kwargs):
+    raise AssertionError('Directory scanned instead of reading the sample files manifest')
+
+
+def test_cached_find_sample_files(tmp_path, monkeypatch):
+    """Test the sample files manifest is used until files are added to the directory."""
+    blast_tsv_dir = tmp_path / 'blast_tsv'
+    shutil.copytree('tests/data/blast_tsv', blast_tsv_dir)
+    cache_dir = tmp_path / 'cache'
+    sample_files = cached_find_sample_files(blast_tsv_dir, 'tsv', cache_dir=cache_dir)
+    assert sorted(sample_files.keys()) == ['blastn-FMDV-vs-nt', 'blastn-NC_045512-vs-nt']
+    with monkeypatch.context() as m:
+        m.setattr(util, 'find_sample_files', fail_find_sample_files)
+        assert cached_find_sample_files(blast_tsv_dir, 'tsv', cache_dir=cache_dir) == sample_files
+    shutil.copy(blast_tsv_dir / 'blastn-FMDV-vs-nt.tsv', blast_tsv_dir / 'blastn-new-vs-nt.tsv')
+    assert 'blastn-new-vs-nt' in cached_find_sample_files(blast_tsv_dir, 'tsv', cache_dir=cache_dir)
+
+
+def test_cli_cache_manifest_reused(tmp_path, monkeypatch):
+    """Test a second run with `--cache` reads the manifest even though Parquet caches were added to the dir."""
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    blast_tsv_dir = tmp_path / 'blast_tsv'
+    shutil.copytree('tests/data/blast_tsv', blast_tsv_dir)
+    args = ['--blast-tsv-dir', str(blast_tsv_dir), '-o', str(tmp_path / 'report.xlsx'), '--cache']
+    assert CliRunner().invoke(cli.main, args).exit_code == 0
+    assert len(list(blast_tsv_dir.glob('*.parquet'))) == 2
+    monkeypatch.setattr(util, 'find_sample_files', fail_find_sample_files)
+    result = CliRunner().invoke(cli.main, args)
+    assert result.exit_code == 0, result.output
+
+
+def test_simple_fasta_parser():
+    """Test FASTA parsing skips leading text and removes whitespace and carriage returns from sequences."""
+    fasta = 'junk line\n\n>seq1 desc here\nACGT\r\nAC GT\n\n>seq2\n>seq3  \nNNNN\n'
+    records = list(simple_fasta_parser(fasta.splitlines(keepends=True)))
+    assert records == [('seq1 desc here', 'ACGTACGT'), ('seq2', ''), ('seq3', 'NNNN')]
+    assert list(simple_fasta_parser(['no records\n'])) == []
+
+
+def test_reverse_complement():
+    """Test reverse complement of IUPAC codes in upper and lower case with U complemented as T."""
+    assert reverse_complement('ACGTMRWSYKVHDBXN') == 'NXVHDBMRSWYKACGT'
+    assert reverse_complement('acgtmrwsykvhdbxn') == 'nxvhdbmrswykacgt'
+    assert reverse_complement('ACGU') == 'ACGT'
+    assert reverse_complement('AcgT-N*z') == 'z*N-AcgT'
+
+
+def test_report_taxid_urls_with_missing_taxid(tmp_path):
+    """Test taxid URLs are formatted as integers when some taxids are missing."""
+    blast_tsv_dir = tmp_path / 'blast_tsv'
+    blast_tsv_dir.mkdir()
+    with open('tests/data/blast_tsv/blastn-FMDV-vs-nt.tsv') as fh:
+        lines = [line.rstrip('\n').split('\t') for line in fh][:3]
+    lines[1][15] = 'N/A'
+    (blast_tsv_dir / 'FMDV.tsv').write_text(''.join('\t'.join(fields) + '\n' for fields in lines))
+    excel_report = tmp_path / 'report.xlsx'
+    result = CliRunner().invoke(cli.main, ['--blast-tsv-dir', str(blast_tsv_dir), '-o', str(excel_report)])
+    assert result.exit_code == 0
+    with zipfile.ZipFile(excel_report) as zf:
+        sheet_xml = zf.read('xl/worksheets/sheet2.xml').decode()
+    assert sheet_xml.count('wwwtax.cgi?id=12122</v>') == 2
+    assert 'wwwtax.cgi?id=12122.0' not in sheet_xml
+
+
+def test_fast_xlsx_too_many_rows(tmp_path, monkeypatch):
+    """Test an error is raised and no workbook is left behind if a sheet has more rows than Excel allows."""
+    monkeypatch.setattr(fast_xlsx, 'MAX_ROWS', 3)
+    xlsx_path = tmp_path / 'report.xlsx'
+    write_report(str(xlsx_path), [Sheet(name='ok', header=['a'], rows=[(1,), (2,)])])
+    assert xlsx_path.exists()
+    with pytest.raises(ValueError, match='more than 2 rows'):
+        write_report(str(xlsx_path), [Sheet(name='too_large', header=['a'], rows=[(1,), (2,), (3,)])])
+    assert not xlsx_path.exists()